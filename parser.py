@@ -3,10 +3,11 @@ import subprocess
 import io
 import json
 import sys
+import os
 
-fp = open('/home/oslab/rust-async-tracing-example/target/debug/profile/dumped_data.txt',"r")
+fp = open(os.environ.get("TRACE_FILE", '/home/oslab/rust-async-tracing-example/target/debug/profile/dumped_data.txt'),"r")
 
-def output_in_json(process_name, threads_list, task_context_collection, output_name, enable_getting_location):
+def output_in_json(process_name, threads_list, task_context_collection, output_name, enable_getting_location, flow_events=None, latency_histogram=None):
     trace_events = []
     for i in threads_list:
         name_of_label = "["+ i +"] " + process_name
@@ -48,11 +49,139 @@ def output_in_json(process_name, threads_list, task_context_collection, output_n
                         else:    # Main thread
                             trace_events.append({"ts": timestamp_m, "ph": "E", "pid": pid, "name": symbol_m, "args": {"Function address (For recognizing anonymous type)": "0x"+function_address}})
 
+    if flow_events is not None:
+        trace_events.extend(flow_events)
     data = {"traceEvents": trace_events, "displayTimeUnit": "ms"} 
+    if latency_histogram is not None:
+        data["metadata"] = {"wake_to_poll_latency_histogram_us": latency_histogram}
     jsonstring = json.dumps(data)
     jsonfile = open(output_name, "w")
     jsonfile.write(jsonstring)
     jsonfile.close()
+def build_task_lifecycles(threads_list, task_context_collection, future_drop_collection):
+    # uftrace does not record return values, so a poll is taken as Poll::Pending when the same future is
+    # polled again before it is dropped, and the last poll before the drop (or the end of trace) as Poll::Ready.
+    # It does not record future instances either, so a future is identified by its thread and the chain of
+    # polls enclosing it; instances of the same type polled from the same thread and chain cannot be told apart.
+    collected = set(task_context_collection)
+    events = [parse_trace_line(i) for i in task_context_collection + [i for i in future_drop_collection if i not in collected]]
+    events.sort(key=lambda event: event[0])
+
+    pid = threads_list[0] if threads_list else "0"
+    lifecycles = []         # Ended lifecycles: {"name", "tid", "chain", "polls": [(entry_ts, exit_ts)], "completed"}
+    live_lifecycle = {}     # (tid, chain, symbol) -> lifecycle that has not completed yet
+    call_stack = {}         # tid -> [(depth, symbol, entry_ts)] of the calls that have not exited yet
+    for timestamp, status, tid, symbol, depth in events:
+        stack = call_stack.setdefault(tid, [])
+        while stack and (stack[-1][0] > depth or (stack[-1][0] == depth and status != "exit")):
+            stack.pop()     # Calls whose exits were not collected
+        if status == "drop":    # drop_in_place of the future: its last poll returned Poll::Ready
+            chain = tuple(call[1] for call in stack)
+            dropped_future = dropped_type(symbol)
+            # Only a future polled on this thread from the calls still enclosing the drop can be the dropped one
+            candidates = [key for key in live_lifecycle if key[0] == tid and live_lifecycle[key]["future_type"] == dropped_future
+                          and common_prefix_length(key[1], chain) == len(key[1])]
+            if candidates:
+                key = max(candidates, key=lambda key: (len(key[1]), live_lifecycle[key]["polls"][-1][1]))
+                end_lifecycle(key, live_lifecycle, lifecycles)
+        elif status == "entry":
+            stack.append((depth, symbol, timestamp))
+        elif stack and stack[-1][0] == depth and stack[-1][1] == symbol:
+            entry_ts = stack.pop()[2]
+            if is_future_poll(symbol):
+                key = (tid, tuple(call[1] for call in stack), symbol)
+                if key not in live_lifecycle:
+                    live_lifecycle[key] = {"name": symbol_modification(symbol) or normalize_symbol(symbol), "tid": tid, "chain": key[1], "future_type": future_type(symbol), "polls": [], "completed": False}
+                live_lifecycle[key]["polls"].append((entry_ts, timestamp))
+    lifecycles.extend(live_lifecycle.values())  # Futures still alive at the end of trace
+
+    flow_events = []
+    latencies = []
+    flow_id = 0
+    for lifecycle in lifecycles:
+        polls = lifecycle["polls"]
+        lifecycle["poll_count"] = len(polls)
+        for (entry_ts, exit_ts), (next_entry_ts, next_exit_ts) in zip(polls, polls[1:]):
+            flow_id += 1
+            latency = round(next_entry_ts - exit_ts, 3)
+            latencies.append(latency)
+            flow_start = {"ts": entry_ts, "ph": "s", "id": flow_id, "pid": pid, "cat": "wake_to_poll", "name": lifecycle["name"],
+                          "args": {"wake_to_poll_latency_us": latency, "poll_count": len(polls)}}
+            flow_end = {"ts": next_entry_ts, "ph": "f", "bp": "e", "id": flow_id, "pid": pid, "cat": "wake_to_poll", "name": lifecycle["name"]}
+            if lifecycle["tid"] != pid:    # Same tid as the poll slices, so the flow binds to them
+                flow_start["tid"] = lifecycle["tid"]
+                flow_end["tid"] = lifecycle["tid"]
+            flow_events.append(flow_start)
+            flow_events.append(flow_end)
+    return lifecycles, flow_events, latencies
+def parse_trace_line(task_context):     # (timestamp in us, entry/exit/drop, tid, symbol, depth)
+    timestamp = re.findall("(.*)  ", task_context)[0].strip().replace("T", "")
+    tid = re.findall(r"  (.*): \[", task_context)[0]
+    symbol = re.findall(r"\] (.*)\(", task_context)[0]
+    status = re.findall(r"\[(.*)\]", task_context)[0].strip()
+    depth = int(re.findall(r"depth: ([0-9]+)", task_context)[0])
+    if status == "entry" and re.search(r"^core::ptr::drop_in_place", normalize_symbol(symbol)):
+        status = "drop"
+    return float(timestamp) * 1000000, status, tid, symbol, depth
+def normalize_symbol(symbol):       # uftrace spells symbols as "a..b::_{{closure}}", rustc demangling as "a::b::{closure#0}"
+    symbol = re.sub(r"\.\.", "::", symbol)
+    symbol = re.sub("_<", "<", symbol)
+    symbol = re.sub("_{", "{", symbol)
+    return symbol.replace("{{closure}}", "{closure#0}")
+def is_future_poll(symbol):     # Task contexts and the GenFuture::poll wrapping an async body are not futures of their own
+    symbol = normalize_symbol(symbol)
+    if re.search(r"::main::main::{closure#0}$", symbol) or re.search(r"^<executor::task_collection::TaskCollection>::generator::{closure#0}", symbol):
+        return False
+    if re.search(r"^<core::future::from_generator::GenFuture<.*> as core::future::future::Future>::poll$", symbol):
+        return False
+    return future_type(symbol) is not None
+def future_type(symbol):        # The type whose drop_in_place completes the future polled by this symbol
+    symbol = normalize_symbol(symbol)
+    poll = re.findall(r"^<(.*) as core::future::future::Future>::poll$", symbol)
+    if poll:
+        return poll[0]
+    if symbol.endswith("::{closure#0}"):    # Body of an async fn or block
+        return "core::future::from_generator::GenFuture<" + symbol + ">"
+    return None
+def dropped_type(symbol):       # The type dropped by a drop_in_place symbol, None if it is not one
+    dropped = re.search(r"^core::ptr::drop_in_place(?:::)?<(.*)>", normalize_symbol(symbol))
+    if dropped:
+        return dropped.group(1)
+    return None
+def common_prefix_length(chain, other_chain):
+    length = 0
+    while length < min(len(chain), len(other_chain)) and chain[length] == other_chain[length]:
+        length += 1
+    return length
+def end_lifecycle(key, live_lifecycle, lifecycles):     # Futures polled inside a completed future are dropped with it
+    tid, chain, symbol = key
+    for other_key in [other_key for other_key in live_lifecycle if other_key[0] == tid and other_key[1][:len(chain) + 1] == chain + (symbol,)]:
+        if other_key in live_lifecycle:
+            end_lifecycle(other_key, live_lifecycle, lifecycles)
+    lifecycle = live_lifecycle.pop(key)
+    lifecycle["completed"] = True
+    lifecycles.append(lifecycle)
+def latency_histogram(latencies):       # Buckets are powers of two in microseconds, keyed by the upper bound
+    histogram = {}
+    for latency in latencies:
+        bucket = 1
+        while bucket < latency:
+            bucket *= 2
+        histogram["<=" + str(bucket)] = histogram.get("<=" + str(bucket), 0) + 1
+    return dict(sorted(histogram.items(), key=lambda item: int(item[0][2:])))
+def print_lifecycle_summary(lifecycles, histogram):
+    print("Wake-to-poll latency histogram (us):")
+    total = sum(histogram.values())
+    for bucket, count in histogram.items():
+        print("%12s %8d %s" % (bucket, count, "#" * (count * 50 // total)))
+    print("Polls to completion (tid, polls, future):")
+    for lifecycle in sorted([lifecycle for lifecycle in lifecycles if lifecycle["completed"]], key=lambda lifecycle: -lifecycle["poll_count"]):
+        print("%8s %8d  %s" % (lifecycle["tid"].strip(), lifecycle["poll_count"], lifecycle["name"]))
+    print("Not completed at the end of trace (tid, polls, future):")
+    for lifecycle in [lifecycle for lifecycle in lifecycles if not lifecycle["completed"]]:
+        print("%8s %8d  %s" % (lifecycle["tid"].strip(), lifecycle["poll_count"], lifecycle["name"]))
+    print("Note: Poll::Pending is inferred from repeated polls, and futures of the same type polled from the same thread")
+    print("      and the same chain of enclosing polls at the same time are counted as one, as uftrace records no instances.")
 def find_location(task_context):                       # find the location of the symbols
     symbol = re.findall(r"] (.*)\(",task_context)       # deal with the task_context
     symbol_m = re.sub(r"\.\.", "::", symbol[0])         # we need to modify the symbol generated from uftrace
@@ -74,6 +203,8 @@ def symbol_modification(task_symbol):
         return re.sub(r"\.\.", "::", task_symbol) 
     
 task_context_collection = []        # To collect all polling contexts of tasks
+future_drop_collection = []         # To collect the drops, which mark the end of the lifecycles of futures
+polled_future_types = set()         # Types of the hand-written futures polled so far
 future_stack = []                   # Record the future name to pair
 find_task_state = 0                 # Record the state of finding task context
 polled_future_number = 0
@@ -94,6 +225,11 @@ for line in fp:
     if re.search(r"reading (.*).dat", line): 
        threads = re.findall(r"reading (.*).dat", line)# record the threads that exist in the process
        thread_list.append(threads[0])  
+    if re.search(r"entry\] _?<.* as core..future..future..Future>::poll\(", line):
+        polled_future_types.add(future_type(re.findall(r"\] (.*)\(", line)[0]))
+    if re.search(r"entry\] core..ptr..drop_in_place", line):   # Keep only the drops of types that can be futures
+        if re.search("GenFuture<", line) or dropped_type(re.findall(r"\] (.*)\(", line)[0]) in polled_future_types:
+            future_drop_collection.append(line)
     
     # State 0
     if find_task_state == 0: 
@@ -210,5 +346,8 @@ for line in fp:
 #for i in task_context_collection:
 #   print(i+"\n")
 #    print(i + "location:" + find_location(i) + "\n")
-output_in_json(process_name, thread_list, task_context_collection, output_name, enable_getting_location)
+lifecycles, flow_events, latencies = build_task_lifecycles(thread_list, task_context_collection, future_drop_collection)
+histogram = latency_histogram(latencies)
+print_lifecycle_summary(lifecycles, histogram)
+output_in_json(process_name, thread_list, task_context_collection, output_name, enable_getting_location, flow_events, histogram)
 #
@@ -0,0 +1,92 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+# parser_test_trace.txt holds two threads of the executor (tid 5 and 6) polling async fn demo::task_a, which awaits the
+# hand-written future demo::Timer:
+#   instance A on tid 5 is pending at t=40us and polled again at t=420us, then dropped,
+#   instance B on tid 6 completes in one poll between the polls of A,
+#   instance C on tid 6 is pending with its Timer, polled again later without it, then dropped,
+#   demo::task_a_other on tid 5 is pending across the drop of A and never dropped.
+trace_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "parser_test_trace.txt")
+parser_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "parser.py")
+
+# Drops that must not end any lifecycle nor crash the parser, merged into the trace by timestamp
+stray_drops = [
+    # GenFuture<demo::task_a> dropped on tid 6, which never polled it, while A is pending on tid 5
+    "1.000200000  6: [entry] core..ptr..drop_in_place<core..future..from_generator..GenFuture<demo..task_a::_{{closure}}>>(1002) depth: 2",
+    "1.000205000  6: [exit ] core..ptr..drop_in_place<core..future..from_generator..GenFuture<demo..task_a::_{{closure}}>>(1002) depth: 2",
+    # The same with a hash suffix
+    "1.000210000  6: [entry] core..ptr..drop_in_place<core..future..from_generator..GenFuture<demo..task_a::_{{closure}}>>::h0123456789abcdef(1002) depth: 2",
+    # A Timer dropped while polling demo::task_a_other on tid 5, outside the chain of the Timer pending in A
+    "1.000330000  5: [entry] core..ptr..drop_in_place<demo..Timer>(1004) depth: 4",
+    # Drops of types that are not futures
+    "1.000332000  5: [entry] core..ptr..drop_in_place<alloc..vec..Vec<u8>>::h0123456789abcdef(1004) depth: 4",
+    "1.000334000  5: [entry] core..ptr..drop_in_place<[u8]>(1004) depth: 4",
+    "1.000336000  5: [entry] core..ptr..drop_in_place.llvm.1234(1004) depth: 4",
+]
+
+def run_parser(extra_lines=()):
+    with tempfile.TemporaryDirectory() as output_dir:
+        with open(trace_file) as tracefile:
+            lines = tracefile.read().splitlines()
+        header = [line for line in lines if line.startswith("reading ")]
+        events = sorted([line for line in lines if not line.startswith("reading ")] + list(extra_lines), key=lambda line: float(line.split()[0]))
+        test_trace_file = os.path.join(output_dir, "trace.txt")
+        with open(test_trace_file, "w") as tracefile:
+            tracefile.write("\n".join(header + events) + "\n")
+        summary = subprocess.run([sys.executable, parser_file], cwd=output_dir, env=dict(os.environ, TRACE_FILE=test_trace_file),
+                                 stdout=subprocess.PIPE, check=True).stdout.decode('utf-8')
+        with open(os.path.join(output_dir, "kernel.json")) as jsonfile:
+            return summary, json.load(jsonfile)
+
+def flow_latencies(data):
+    flows = {}
+    for event in data["traceEvents"]:
+        if event["ph"] in ("s", "f"):
+            flows.setdefault(event["id"], []).append(event)
+    latencies = []
+    for flow in flows.values():
+        flow_start, flow_end = flow
+        assert (flow_start["ph"], flow_end["ph"], flow_end["bp"]) == ("s", "f", "e")
+        assert flow_start.get("tid") == flow_end.get("tid")     # A future is never paired with a poll from another task
+        latencies.append((flow_start.get("tid", "5"), flow_start["name"], flow_start["args"]["wake_to_poll_latency_us"], flow_start["args"]["poll_count"]))
+    return sorted(latencies)
+
+def test_wake_to_poll_flows():
+    summary, data = run_parser()
+    assert flow_latencies(data) == [
+        ("5", "<demo::Timer as core::future::future::Future>::poll", 395.0, 2),
+        ("5", "demo..task_a", 380.0, 2),
+        ("5", "demo..task_a_other", 480.0, 2),
+        ("6", "demo..task_a", 530.0, 2),
+    ]
+    assert data["metadata"]["wake_to_poll_latency_histogram_us"] == {"<=512": 3, "<=1024": 1}
+
+def test_polls_to_completion():
+    summary, data = run_parser()
+    completed = summary.split("Polls to completion (tid, polls, future):\n")[1].split("Not completed")[0].splitlines()
+    pending = summary.split("Not completed at the end of trace (tid, polls, future):\n")[1].split("Note:")[0].splitlines()
+    assert sorted(line.split() for line in completed) == sorted([
+        ["5", "2", "<demo::Timer", "as", "core::future::future::Future>::poll"],   # Dropped by A
+        ["5", "2", "demo..task_a"],                                                 # A
+        ["6", "1", "<demo::Timer", "as", "core::future::future::Future>::poll"],   # Dropped by B
+        ["6", "1", "demo..task_a"],                                                 # B
+        ["6", "1", "<demo::Timer", "as", "core::future::future::Future>::poll"],   # Dropped with C
+        ["6", "2", "demo..task_a"],                                                 # C
+    ])
+    assert [line.split() for line in pending] == [["5", "2", "demo..task_a_other"]]    # The drop of GenFuture<demo::task_a> does not match it
+
+def test_stray_drops_end_nothing():
+    summary, data = run_parser()
+    stray_summary, stray_data = run_parser(stray_drops)
+    assert flow_latencies(stray_data) == flow_latencies(data)
+    assert stray_data["metadata"] == data["metadata"]
+    assert stray_summary == summary
+
+if __name__ == "__main__":
+    test_wake_to_poll_flows()
+    test_polls_to_completion()
+    test_stray_drops_end_nothing()